@@ -1,24 +1,51 @@
 import requests
+import json
+try:
+    import orjson
+except ImportError:  # 未安装orjson时退回标准库json
+    orjson = None
 from datetime import datetime
 import logging
 import os
 import urllib3
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 import socket
 from urllib.parse import urlparse
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# 并发拉取分页时的最大线程数
+MAX_WORKERS = 8
+
+# 连接池大小, 同时也是单个client同时在途请求数的上限
+POOL_MAXSIZE = 64
+
+# GET响应缓存的有效期(秒)、最大条目数和最大字节数(按原始响应体大小计, 解析后约为2-3倍)
+CACHE_TTL = 120
+CACHE_MAXSIZE = 2048
+CACHE_MAXBYTES = 16 * 1024 * 1024
+# merge requests变化频繁, 缓存时间更短
+MERGE_REQUESTS_CACHE_TTL = 60
+
+# 分页用到的响应头, 缓存时只保留这些
+PAGINATION_HEADERS = ('X-Total', 'X-Total-Pages', 'X-Next-Page')
+
+# 统计只用到commit的这些字段, 其余字段(parent_ids, committer_*, message等)不保留
+COMMIT_FIELDS = ('id', 'author_name', 'authored_date', 'title')
+
+class GitLabAPIError(Exception):
+    """GitLab接口返回了无法使用的结果(项目不存在、响应不是合法JSON等)"""
+
+
 class GitLabClient:
     def __init__(self, base_url, private_token):
         self.base_url = base_url.rstrip('/')
-        self.headers = {
-            'PRIVATE-TOKEN': private_token,
-            'Content-Type': 'application/json'
-        }
-        
         # 创建不使用代理的session
         self.session = requests.Session()
         # 显式禁用所有代理
@@ -26,14 +53,162 @@ class GitLabClient:
             'http': None,
             'https': None
         }
+        # 请求头只在session上设置一次; 只发GET请求, 不需要Content-Type
+        self.session.headers.update({
+            'PRIVATE-TOKEN': private_token,
+            'Accept': 'application/json',
+            # 分页JSON压缩率高, 显式声明支持br(需安装brotli)
+            'Accept-Encoding': 'gzip, deflate, br'
+        })
+        
+        # 连接池与重试: 复用TCP/TLS连接, 避免分页请求重复握手
+        retry = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 502, 503, 504]
+        )
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=POOL_MAXSIZE,
+            max_retries=retry
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         
         self.request_kwargs = {
             'verify': False,
             'timeout': 30
         }
         
-        logger.debug(f"Initialized GitLab client with base URL: {self.base_url}")
-        logger.debug(f"Session proxies: {self.session.proxies}")
+        # 项目级和分页级线程池嵌套时, 限制同时在途的请求数不超过连接池大小
+        self._request_slots = threading.BoundedSemaphore(POOL_MAXSIZE)
+        
+        # GET响应缓存: (url, params) -> {'etag', 'last_modified', 'body', 'headers', 'size', 'expires'}
+        self._cache = {}
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+        
+        # 单项目统计结果缓存, 由GitLabStatsService读写; 放在client上按(url, token)隔离,
+        # 不同token之间不会共享统计结果
+        self.project_stats_cache = OrderedDict()
+        # 项目ID -> 缓存统计结果时项目的last_activity_at
+        self.project_stats_activity = {}
+        self.project_stats_lock = threading.Lock()
+        
+        logger.debug("Initialized GitLab client with base URL: %s", self.base_url)
+        logger.debug("Session proxies: %s", self.session.proxies)
+    
+    def close(self):
+        """关闭session, 释放连接池中的连接"""
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _get(self, url, params=None):
+        """发送GET请求, 返回(解析后的JSON, 分页响应头), 带TTL缓存
+        
+        缓存中只保存解析后的JSON和分页头, 不保留原始响应。
+        缓存过期后携带If-None-Match/If-Modified-Since重新验证, 服务端返回304时复用缓存的数据。
+        请求失败时抛出requests.HTTPError
+        """
+        if not self._is_cacheable(url, params):
+            with self._request_slots:
+                response = self.session.get(url, params=params, **self.request_kwargs)
+            response.raise_for_status()
+            return self._parse(response), self._pagination_headers(response)
+        
+        key = (url, frozenset((params or {}).items()))
+        now = time.monotonic()
+        with self._cache_lock:
+            entry = self._cache.get(key)
+        
+        if entry and entry['expires'] > now:
+            return entry['body'], entry['headers']
+        
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        
+        with self._request_slots:
+            response = self.session.get(
+                url,
+                params=params,
+                headers=headers or None,
+                **self.request_kwargs
+            )
+        
+        if response.status_code == 304 and entry:
+            body, headers, size = entry['body'], entry['headers'], entry['size']
+        else:
+            response.raise_for_status()
+            body = self._parse(response)
+            headers = self._pagination_headers(response)
+            size = len(response.content)
+        
+        with self._cache_lock:
+            old = self._cache.pop(key, None)
+            if old:
+                self._cache_bytes -= old['size']
+            if size <= CACHE_MAXBYTES:
+                self._cache[key] = {
+                    'etag': response.headers.get('ETag') or (entry and entry['etag']),
+                    'last_modified': response.headers.get('Last-Modified') or (entry and entry['last_modified']),
+                    'body': body,
+                    'headers': headers,
+                    'size': size,
+                    'expires': now + self._cache_ttl(url)
+                }
+                self._cache_bytes += size
+            # 超出容量时淘汰最早写入的条目
+            while len(self._cache) > CACHE_MAXSIZE or self._cache_bytes > CACHE_MAXBYTES:
+                self._cache_bytes -= self._cache.pop(next(iter(self._cache)))['size']
+        return body, headers
+    
+    @staticmethod
+    def _is_cacheable(url, params):
+        """commit列表页体积大且只在单次统计中用到一次, 不缓存; per_page=1的计数请求仍缓存"""
+        return not (url.endswith('/repository/commits') and (params or {}).get('per_page') != 1)
+    
+    @staticmethod
+    def _pagination_headers(response):
+        """只保留分页用到的响应头"""
+        return {
+            name: response.headers[name]
+            for name in PAGINATION_HEADERS
+            if name in response.headers
+        }
+    
+    @staticmethod
+    def _cache_ttl(url):
+        """按接口选择缓存有效期"""
+        if url.endswith('/merge_requests'):
+            return MERGE_REQUESTS_CACHE_TTL
+        return CACHE_TTL
+    
+    def invalidate(self, project_id=None):
+        """清除指定项目的缓存响应, 不指定项目时清空全部缓存"""
+        with self._cache_lock:
+            if project_id is None:
+                self._cache.clear()
+                self._cache_bytes = 0
+                return
+            prefix = f"{self.base_url}/api/v4/projects/{project_id}/"
+            for key in [key for key in self._cache if key[0].startswith(prefix)]:
+                self._cache_bytes -= self._cache.pop(key)['size']
+    
+    @staticmethod
+    def _parse(response):
+        """解析响应体(优先orjson)"""
+        try:
+            return (orjson or json).loads(response.content)
+        except ValueError as e:
+            raise GitLabAPIError(f"Invalid JSON response from {response.url}") from e
     
     def _test_proxy(self):
         """测试代理连接"""
@@ -45,15 +220,15 @@ class GitLabClient:
                 sock.settimeout(5)
                 sock.connect((host, int(port)))
                 sock.close()
-                logger.info(f"Successfully connected to proxy {proxy}")
+                logger.info("Successfully connected to proxy %s", proxy)
                 # 测试代理是否可用
                 test_url = 'http://www.google.com'
-                logger.debug(f"Testing proxy with {test_url}")
+                logger.debug("Testing proxy with %s", test_url)
                 response = requests.get(test_url, proxies=self.session.proxies, timeout=5, verify=False)
                 response.raise_for_status()
                 logger.info("Proxy is working correctly")
         except Exception as e:
-            logger.error(f"Failed to connect to proxy: {str(e)}")
+            logger.error("Failed to connect to proxy: %s", e)
             raise
     
     def _test_connection(self):
@@ -64,11 +239,42 @@ class GitLabClient:
                 **self.request_kwargs
             )
             response.raise_for_status()
-            logger.info(f"Successfully connected to GitLab. Version: {response.json()}")
+            logger.info("Successfully connected to GitLab. Version: %s", self._parse(response))
         except Exception as e:
-            logger.error(f"Failed to connect to GitLab: {str(e)}")
+            logger.error("Failed to connect to GitLab: %s", e)
             raise
     
+    def _get_page(self, url, params, page):
+        """获取列表接口的单页数据, 返回(解析后的JSON, 分页响应头)"""
+        logger.debug("Requesting %s (page %s)", url, page)
+        return self._get(url, {**params, 'page': page})
+    
+    def _get_pages(self, url, params):
+        """逐页返回列表接口的(页码, 数据)
+        
+        第一页返回X-Total-Pages时并发获取剩余页, 否则按X-Next-Page顺序翻页。
+        请求失败时抛出异常, 调用方已消费的页不受影响
+        """
+        body, headers = self._get_page(url, params, 1)
+        yield 1, body
+        
+        total_pages = headers.get('X-Total-Pages')
+        if total_pages:
+            pages = range(2, int(total_pages) + 1)
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                yield from zip(pages, executor.map(
+                    lambda page: self._get_page(url, params, page)[0],
+                    pages
+                ))
+        else:
+            # 直接读取X-Next-Page头, 避免解析Link头
+            next_page = headers.get('X-Next-Page')
+            while next_page:
+                page = int(next_page)
+                body, headers = self._get_page(url, params, page)
+                yield page, body
+                next_page = headers.get('X-Next-Page')
+    
     def get_group_projects(self, group_id):
         """获取组内所有项目
         
@@ -76,44 +282,20 @@ class GitLabClient:
             group_id: 组ID
         """
         url = f"{self.base_url}/api/v4/groups/{group_id}/projects"
-        params = {'per_page': 100}  # 增加每页数量
+        # simple=true只返回项目的基础字段(仍包含last_activity_at)
+        params = {'per_page': 100, 'simple': 'true'}  # 增加每页数量
         
-        logger.info(f"Fetching projects for group {group_id}")
+        logger.info("Fetching projects for group %s", group_id)
         
         all_projects = []
-        page = 1
-        
-        while True:
-            try:
-                params['page'] = page
-                logger.debug(f"Fetching page {page} of projects")
-                
-                response = self.session.get(
-                    url,
-                    headers=self.headers,
-                    params=params,
-                    **self.request_kwargs
-                )
-                response.raise_for_status()
-                
-                projects = response.json()
-                if not projects:
-                    break
-                    
+        try:
+            for page, projects in self._get_pages(url, params):
                 all_projects.extend(projects)
-                logger.debug(f"Found {len(projects)} projects on page {page}")
-                
-                # 检查是否有下一页
-                if 'next' not in response.links:
-                    break
-                    
-                page += 1
-                
-            except Exception as e:
-                logger.error(f"Error fetching projects page {page}: {str(e)}")
-                break
+                logger.debug("Found %s projects on page %s", len(projects), page)
+        except (requests.exceptions.RequestException, GitLabAPIError) as e:
+            logger.error("Error fetching projects for group %s: %s", group_id, e)
         
-        logger.info(f"Total projects found: {len(all_projects)}")
+        logger.info("Total projects found: %s", len(all_projects))
         return all_projects
     
     def get_project_branches(self, project_id):
@@ -122,180 +304,124 @@ class GitLabClient:
         params = {'per_page': 100}
         
         all_branches = []
-        page = 1
-        
-        while True:
-            try:
-                params['page'] = page
-                logger.debug(f"Fetching branches page {page} for project {project_id}")
-                
-                response = self.session.get(
-                    url,
-                    headers=self.headers,
-                    params=params,
-                    **self.request_kwargs
-                )
-                response.raise_for_status()
-                
-                branches = response.json()
-                if not branches:
-                    break
-                    
+        try:
+            for page, branches in self._get_pages(url, params):
                 all_branches.extend(branches)
-                logger.debug(f"Found {len(branches)} branches on page {page}")
-                
-                if 'next' not in response.links:
-                    break
-                    
-                page += 1
-                
-            except Exception as e:
-                logger.error(f"Error fetching branches page {page}: {str(e)}")
-                break
+                logger.debug("Found %s branches on page %s", len(branches), page)
+        except (requests.exceptions.RequestException, GitLabAPIError) as e:
+            logger.error("Error fetching branches for project %s: %s", project_id, e)
         
-        logger.info(f"Total branches found for project {project_id}: {len(all_branches)}")
+        logger.info("Total branches found for project %s: %s", project_id, len(all_branches))
         return all_branches
     
-    def get_project_commits(self, project_id, since=None, until=None):
-        """获取项目所有分支的commits"""
-        try:
-            # 验证项目存在
-            project_url = f"{self.base_url}/api/v4/projects/{project_id}"
-            logger.debug(f"Verifying project existence: {project_url}")
-            
-            response = self.session.get(
-                project_url,
-                headers=self.headers,
-                **self.request_kwargs
-            )
-            
-            if response.status_code == 404:
-                logger.error(f"Project {project_id} not found")
-                raise Exception(f"Project {project_id} not found")
-            response.raise_for_status()
-            
-            project_info = response.json()
-            logger.debug(f"Found project: {project_info.get('name', 'Unknown')}")
-
-            # 获取所有分支
-            branches = self.get_project_branches(project_id)
-            all_commits = set()  # 使用集合去重
-            
-            for branch in branches:
-                branch_name = branch['name']
-                logger.debug(f"Fetching commits for branch: {branch_name}")
-                
-                page = 1
-                while True:
-                    try:
-                        url = f"{self.base_url}/api/v4/projects/{project_id}/repository/commits"
-                        params = {
-                            'ref_name': branch_name,
-                            'per_page': 100,
-                            'page': page
-                        }
-                        
-                        if since:
-                            params['since'] = since
-                        if until:
-                            params['until'] = until
-
-                        logger.debug(f"Requesting commits from branch {branch_name} (page {page})")
-                        response = self.session.get(
-                            url,
-                            headers=self.headers,
-                            params=params,
-                            **self.request_kwargs
-                        )
-                        
-                        if response.status_code == 200:
-                            commits = response.json()
-                            if not commits:
-                                break
-                                
-                            # 使用commit id作为唯一标识添加到集合中
-                            for commit in commits:
-                                commit_tuple = (
-                                    commit['id'],
-                                    commit['author_name'],
-                                    commit['authored_date'],
-                                    commit['title']
-                                )
-                                all_commits.add(commit_tuple)
-                                
-                            logger.debug(f"Found {len(commits)} commits on page {page} for branch {branch_name}")
-                            
-                            if 'next' not in response.links:
-                                break
-                                
-                            page += 1
-                        else:
-                            logger.warning(f"Failed to get commits for branch {branch_name}: {response.status_code}")
-                            break
-                            
-                    except Exception as e:
-                        logger.error(f"Error fetching commits for branch {branch_name} page {page}: {str(e)}")
-                        break
-            
-            # 转换回列表格式，并重建完整的commit对象
-            commits_list = [
-                {
-                    'id': commit_id,
-                    'author_name': author_name,
-                    'authored_date': authored_date,
-                    'title': title
-                }
-                for commit_id, author_name, authored_date, title in all_commits
-            ]
-            
-            logger.info(f"Total unique commits found across all branches: {len(commits_list)}")
-            return commits_list
-
-        except Exception as e:
-            logger.error(f"Error in get_project_commits: {str(e)}")
-            raise
+    @staticmethod
+    def _commits_params(since=None, until=None):
+        """构造commits接口的查询参数"""
+        params = {
+            'all': 'true',
+            'per_page': 100,
+            'with_stats': 'false'
+        }
+        # since/until由GitLab在服务端过滤, 分页本身就只覆盖统计区间;
+        # all=true时结果并不严格按authored_date排序, 不能按日期提前终止翻页
+        if since:
+            params['since'] = since
+        if until:
+            params['until'] = until
+        return params
     
-    def get_project_merge_requests(self, project_id, state='all', since=None, until=None):
-        """获取项目的merge requests"""
-        url = f"{self.base_url}/api/v4/projects/{project_id}/merge_requests"
+    @staticmethod
+    def _merge_requests_params(state='all', since=None, until=None):
+        """构造merge requests接口的查询参数"""
         params = {'state': state, 'per_page': 100}
         if since:
             params['created_after'] = since
         if until:
             params['created_before'] = until
+        return params
+    
+    def _get_total(self, url, params):
+        """以per_page=1请求第一页, 从X-Total头读取总数
         
-        logger.debug(f"Requesting merge requests from: {url} with params: {params}")
+        GitLab对超过10000条的结果不返回X-Total, 此时返回None
+        """
+        _, headers = self._get_page(url, {**params, 'per_page': 1}, 1)
+        total = headers.get('X-Total')
+        return int(total) if total else None
+    
+    def iter_project_commits(self, project_id, since=None, until=None):
+        """逐条返回项目所有分支的commits, 不在内存中保留完整列表
         
-        all_merge_requests = []
-        page = 1
+        使用all=true让GitLab在服务端合并所有ref并去重, 无需逐分支拉取
+        """
+        try:
+            url = f"{self.base_url}/api/v4/projects/{project_id}/repository/commits"
+            params = self._commits_params(since, until)
+            
+            # 并发分页期间有新提交推送时, 相邻页可能出现重复commit,
+            # 按20字节的commit id去重, 并只保留需要的字段
+            seen_ids = set()
+            for _, commits in self._get_pages(url, params):
+                for commit in commits:
+                    commit_id = bytes.fromhex(commit['id'])
+                    if commit_id in seen_ids:
+                        continue
+                    seen_ids.add(commit_id)
+                    yield {field: commit[field] for field in COMMIT_FIELDS}
+            
+            logger.info("Total unique commits found across all branches: %s", len(seen_ids))
+
+        except requests.exceptions.HTTPError as e:
+            # 不再单独验证项目是否存在, 由commits接口的404判断
+            if e.response is not None and e.response.status_code == 404:
+                logger.error("Project %s not found", project_id)
+                raise GitLabAPIError(f"Project {project_id} not found") from e
+            logger.error("Error in get_project_commits: %s", e)
+            raise
+        except (requests.exceptions.RequestException, GitLabAPIError) as e:
+            logger.error("Error in get_project_commits: %s", e)
+            raise
+    
+    def get_project_commits(self, project_id, since=None, until=None):
+        """获取项目所有分支的commits"""
+        return list(self.iter_project_commits(project_id, since=since, until=until))
+    
+    def get_project_commit_count(self, project_id, since=None, until=None):
+        """获取项目commits总数, 不拉取commit列表"""
+        url = f"{self.base_url}/api/v4/projects/{project_id}/repository/commits"
+        total = self._get_total(url, self._commits_params(since, until))
+        if total is None:
+            total = sum(1 for _ in self.iter_project_commits(project_id, since=since, until=until))
+        return total
+    
+    def get_project_merge_request_count(self, project_id, state='all', since=None, until=None):
+        """获取项目merge requests总数, 不拉取merge request列表"""
+        url = f"{self.base_url}/api/v4/projects/{project_id}/merge_requests"
+        total = self._get_total(url, self._merge_requests_params(state, since, until))
+        if total is None:
+            total = len(self.get_project_merge_requests(project_id, state=state, since=since, until=until))
+        return total
+    
+    def iter_project_merge_requests(self, project_id, state='all', since=None, until=None):
+        """逐条返回项目的merge requests, 不在内存中保留完整列表"""
+        url = f"{self.base_url}/api/v4/projects/{project_id}/merge_requests"
+        params = self._merge_requests_params(state, since, until)
         
-        while True:
-            try:
-                params['page'] = page
-                # 移除额外的timeout参数，使用request_kwargs中的设置
-                response = self.session.get(
-                    url, 
-                    headers=self.headers, 
-                    params=params,
-                    **self.request_kwargs
-                )
-                response.raise_for_status()
-                
-                merge_requests = response.json()
-                if not merge_requests:
-                    break
-                    
-                all_merge_requests.extend(merge_requests)
-                logger.debug(f"Found {len(merge_requests)} merge requests on page {page}")
-                
-                if 'next' not in response.links:
-                    break
-                    
-                page += 1
-                
-            except Exception as e:
-                logger.error(f"Error fetching merge requests page {page}: {str(e)}")
-                break
+        logger.debug("Requesting merge requests from: %s with params: %s", url, params)
         
-        logger.info(f"Total merge requests found: {len(all_merge_requests)}")
-        return all_merge_requests 
\ No newline at end of file
+        total = 0
+        try:
+            for page, merge_requests in self._get_pages(url, params):
+                total += len(merge_requests)
+                logger.debug("Found %s merge requests on page %s", len(merge_requests), page)
+                yield from merge_requests
+        except (requests.exceptions.RequestException, GitLabAPIError) as e:
+            # 中途失败时向上抛出, 避免部分计数被当作完整结果
+            logger.error("Error fetching merge requests for project %s: %s", project_id, e)
+            raise
+        
+        logger.info("Total merge requests found: %s", total)
+    
+    def get_project_merge_requests(self, project_id, state='all', since=None, until=None):
+        """获取项目的merge requests"""
+        return list(self.iter_project_merge_requests(project_id, state=state, since=since, until=until))
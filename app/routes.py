@@ -1,34 +1,102 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify, stream_with_context
 from .gitlab_client import GitLabClient
 from .services import GitLabStatsService
+from collections import OrderedDict
+import hashlib
+import json
 import logging
 import requests
+try:
+    import orjson
+except ImportError:  # 未安装orjson时退回jsonify
+    orjson = None
+import threading
 
 api = Blueprint('api', __name__)
 logger = logging.getLogger(__name__)
 
+# /stats请求必须包含的字段
+REQUIRED_FIELDS = frozenset(('gitlab_url', 'private_token', 'group_id', 'start_date', 'end_date'))
+
+# 按(url, token哈希)复用GitLabClient, 保留连接池和响应缓存
+MAX_CLIENTS = 32
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+def _get_client(gitlab_url, private_token):
+    """获取或创建GitLabClient, 超出MAX_CLIENTS时淘汰最久未使用的"""
+    key = (gitlab_url, hashlib.sha256(private_token.encode()).hexdigest())
+    evicted = []
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = GitLabClient(gitlab_url, private_token)
+            _clients[key] = client
+            while len(_clients) > MAX_CLIENTS:
+                evicted.append(_clients.popitem(last=False)[1])
+        else:
+            _clients.move_to_end(key)
+    # 在锁外关闭被淘汰的client, 释放其连接池;
+    # 仍在使用它的请求不受影响, 已借出的连接用完后直接关闭, 之后的请求会新建连接池
+    for old_client in evicted:
+        old_client.close()
+    return client
+
+def _dumps(obj):
+    """将对象编码为JSON字节串"""
+    if orjson is None:
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+def _stream_stats(events):
+    """将collect_stats_stream的结果逐块编码为一个JSON对象
+    
+    projects数组中的项目按处理顺序逐个写出, 其余字段在最后写出
+    """
+    yield b'{"projects":['
+    first = True
+    for kind, payload in events:
+        if kind == 'project':
+            if not first:
+                yield b','
+            first = False
+            yield _dumps(payload)
+        else:
+            yield b']'
+            for key, value in payload.items():
+                if key != 'projects':
+                    yield b',' + _dumps(key) + b':' + _dumps(value)
+    yield b'}'
+
 @api.route('/stats', methods=['POST'])
 def get_stats():
     try:
         data = request.json
-        logger.debug(f"Received configuration: {data}")
+        logger.debug("Received configuration: %s", data)
         
         if not data:
             return jsonify({'error': 'No JSON data provided'}), 400
         
+        if not isinstance(data, dict):
+            return jsonify({'error': 'JSON body must be an object'}), 400
+        
         # 验证必要的字段
-        required_fields = ['gitlab_url', 'private_token', 'group_id', 'start_date', 'end_date']
-        missing_fields = [field for field in required_fields if field not in data]
+        missing_fields = REQUIRED_FIELDS - data.keys()
         if missing_fields:
-            return jsonify({'error': f'Missing required fields: {missing_fields}'}), 400
+            return jsonify({'error': f'Missing required fields: {sorted(missing_fields)}'}), 400
         
         # 验证GitLab URL格式
         if not data['gitlab_url'].startswith(('http://', 'https://')):
             return jsonify({'error': 'GitLab URL must start with http:// or https://'}), 400
         
-        logger.debug(f"Received request with GitLab URL: {data['gitlab_url']} and group ID: {data['group_id']}")
+        # 验证need_contributors必须为JSON布尔值
+        need_contributors = data.get('need_contributors', True)
+        if not isinstance(need_contributors, bool):
+            return jsonify({'error': 'need_contributors must be a boolean'}), 400
+        
+        logger.debug("Received request with GitLab URL: %s and group ID: %s", data['gitlab_url'], data['group_id'])
         
-        gitlab_client = GitLabClient(
+        gitlab_client = _get_client(
             data['gitlab_url'],
             data['private_token']
         )
@@ -37,13 +105,13 @@ def get_stats():
         try:
             projects = gitlab_client.get_group_projects(data['group_id'])
             if not projects:
-                logger.error(f"No projects found in group {data['group_id']}")
+                logger.error("No projects found in group %s", data['group_id'])
                 return jsonify({'error': f"No projects found in group {data['group_id']}"}), 404
-            logger.debug(f"Successfully connected to GitLab and retrieved {len(projects)} projects")
+            logger.debug("Successfully connected to GitLab and retrieved %s projects", len(projects))
         except requests.exceptions.RequestException as e:
             status_code = e.response.status_code if hasattr(e, 'response') and e.response else 500
             error_message = e.response.text if hasattr(e, 'response') and e.response else str(e)
-            logger.error(f"Failed to connect to GitLab: {error_message}")
+            logger.error("Failed to connect to GitLab: %s", error_message)
             
             if status_code == 401:
                 return jsonify({'error': 'Invalid private token or unauthorized access'}), 401
@@ -54,18 +122,38 @@ def get_stats():
         
         try:
             service = GitLabStatsService(gitlab_client)
+            
+            # ?stream=1时边统计边写出项目结果, 不在内存中保留全部项目
+            if request.args.get('stream', '').lower() in ('1', 'true'):
+                events = service.collect_stats_stream(
+                    data['group_id'],
+                    data['start_date'],
+                    data['end_date'],
+                    need_contributors=need_contributors
+                )
+                return current_app.response_class(
+                    stream_with_context(_stream_stats(events)),
+                    mimetype='application/json'
+                )
+            
             stats = service.collect_stats(
                 data['group_id'],
                 data['start_date'],
-                data['end_date']
+                data['end_date'],
+                need_contributors=need_contributors
+            )
+            if orjson is None:
+                return jsonify(stats)
+            return current_app.response_class(
+                orjson.dumps(stats, option=orjson.OPT_NON_STR_KEYS),
+                mimetype='application/json'
             )
-            return jsonify(stats)
         except requests.exceptions.RequestException as e:
             status_code = e.response.status_code if hasattr(e, 'response') and e.response else 500
             error_message = e.response.text if hasattr(e, 'response') and e.response else str(e)
-            logger.error(f"Error collecting stats: {error_message}")
+            logger.error("Error collecting stats: %s", error_message)
             return jsonify({'error': f'Error collecting stats: {error_message}'}), status_code
             
     except Exception as e:
-        logger.error(f"Error processing request: {str(e)}")
+        logger.error("Error processing request: %s", e)
         return jsonify({'error': str(e)}), 500 
\ No newline at end of file
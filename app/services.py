@@ -1,17 +1,72 @@
-from collections import defaultdict
-from .gitlab_client import GitLabClient
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from .gitlab_client import GitLabClient, GitLabAPIError
+from .utils import parse_datetime
 import logging
+import requests
+import sys
 
 logger = logging.getLogger(__name__)
 
+# 并发收集项目数据时的最大线程数
+MAX_WORKERS = 32
+
+# 暂时排除统计的项目ID
+EXCLUDED_PROJECT_IDS = frozenset({174})
+
+# 单个client缓存的单项目统计结果上限, 键为(项目ID, last_activity_at, 统计区间, need_contributors)。
+# 项目没有新活动时, 已结束区间内的统计结果不会变化; 服务对象按请求创建, 缓存放在复用的client上
+PROJECT_STATS_CACHE_MAXSIZE = 4096
+
+def merge_contributors(commits_by_author, mrs_by_author):
+    """将按作者计数的commits/merge requests合并为 {作者: {'commits', 'merge_requests'}}"""
+    return {
+        author: {
+            'commits': commits_by_author[author],
+            'merge_requests': mrs_by_author[author]
+        }
+        for author in dict.fromkeys((*commits_by_author, *mrs_by_author))
+    }
+
+def contributor_list(commits_by_author, mrs_by_author):
+    """一次遍历生成前端期望的贡献者列表 [{'name', 'commits', 'merge_requests'}]"""
+    return [
+        {
+            'name': author,
+            'commits': commits_by_author[author],
+            'merge_requests': mrs_by_author[author]
+        }
+        for author in dict.fromkeys((*commits_by_author, *mrs_by_author))
+    ]
+
 class GitLabStatsService:
-    def __init__(self, gitlab_client):
+    def __init__(self, gitlab_client, excluded_project_ids=EXCLUDED_PROJECT_IDS):
         self.client = gitlab_client
+        self.excluded_project_ids = frozenset(excluded_project_ids)
+    
+    def collect_stats(self, group_id, start_date, end_date, need_contributors=True):
+        """收集统计数据
+        
+        need_contributors为False时只统计总数, 不拉取commit/merge request列表
+        """
+        projects_out = []
+        for kind, payload in self.collect_stats_stream(group_id, start_date, end_date, need_contributors):
+            if kind == 'project':
+                projects_out.append(payload)
+            else:
+                stats = payload
+        stats['projects'] = projects_out
+        return stats
     
-    def collect_stats(self, group_id, start_date, end_date):
-        """收集统计数据"""
+    def collect_stats_stream(self, group_id, start_date, end_date, need_contributors=True):
+        """逐个产出统计结果, 不在内存中保留全部项目的统计
+        
+        每处理完一个项目产出('project', 项目统计), 最后产出('summary', stats);
+        stats与collect_stats的返回值相同, 只是projects为空列表
+        """
         projects = self.client.get_group_projects(group_id)
-        logger.info(f"Found {len(projects)} total projects in group {group_id}")
+        logger.info("Found %s total projects in group %s", len(projects), group_id)
         
         stats = {
             'total_commits': 0,
@@ -21,75 +76,100 @@ class GitLabStatsService:
             'projects': [],
             'skipped_projects': [],
             'partial_data_projects': [],
-            'contributors': defaultdict(lambda: {
-                'commits': 0,
-                'merge_requests': 0
-            })
+            'contributors': {}
         }
+        # 全局贡献者统计, 汇总完成后再组装为嵌套dict
+        commits_by_author = Counter()
+        mrs_by_author = Counter()
         
+        # 先分出被排除的项目, 统计循环中不再逐个判断
+        included_projects = []
         for project in projects:
-            project_id = project['id']
-            project_name = project.get('name', 'Unknown')
-            logger.info(f"Processing project {project_name} (ID: {project_id})")
-            
-            if project_id == 174:
-                logger.warning(f"Skipping project ID 174 ({project_name})")
+            if project['id'] in self.excluded_project_ids:
+                logger.warning("Skipping excluded project ID %s (%s)", project['id'], project.get('name', 'Unknown'))
                 stats['skipped_projects'].append({
-                    'id': project_id,
-                    'name': project_name,
+                    'id': project['id'],
+                    'name': project.get('name', 'Unknown'),
                     'reason': 'Project ID temporarily excluded'
                 })
-                continue
+            else:
+                included_projects.append(project)
+        
+        # 汇总值先累加到局部变量, 循环结束后一次写入stats
+        processed_projects = 0
+        total_commits = 0
+        total_merge_requests = 0
+        
+        # 并发收集各项目数据, 结果按项目顺序在主线程中汇总
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = []
+            for project in included_projects:
+                logger.info("Processing project %s (ID: %s)", project.get('name', 'Unknown'), project['id'])
+                futures.append((
+                    project,
+                    executor.submit(
+                        self._collect_project_stats_cached,
+                        project,
+                        start_date,
+                        end_date,
+                        need_contributors
+                    )
+                ))
             
-            try:
-                project_stats = self._collect_project_stats(project, start_date, end_date)
+            for project, future in futures:
+                project_id = project['id']
+                project_name = project.get('name', 'Unknown')
                 
-                # 转换为前端期望的格式
-                formatted_stats = {
-                    'id': project_stats['id'],
-                    'name': project_stats['name'],
-                    'commits': project_stats['commit_count'],
-                    'merge_requests': project_stats['merge_request_count'],
-                    'contributors': [
-                        {
-                            'name': author,
-                            'commits': contributor_stats['commits'],
-                            'merge_requests': contributor_stats['merge_requests']
-                        }
-                        for author, contributor_stats in project_stats['contributors'].items()
-                    ]
-                }
+                try:
+                    project_stats = future.result()
                 
-                # 更新全局贡献者统计
-                for author, contributor_stats in project_stats['contributors'].items():
-                    stats['contributors'][author]['commits'] += contributor_stats['commits']
-                    stats['contributors'][author]['merge_requests'] += contributor_stats['merge_requests']
+                    # 转换为前端期望的格式
+                    formatted_stats = {
+                        'id': project_stats['id'],
+                        'name': project_stats['name'],
+                        'commits': project_stats['commit_count'],
+                        'merge_requests': project_stats['merge_request_count'],
+                        'contributors': contributor_list(
+                            project_stats['commits_by_author'],
+                            project_stats['mrs_by_author']
+                        )
+                    }
                 
-                if project_stats.get('errors'):
-                    logger.warning(f"Partial data for project {project_name}: {project_stats['errors']}")
-                    stats['partial_data_projects'].append({
-                        'id': project_id,
-                        'name': project_name,
-                        'errors': project_stats['errors']
-                    })
+                    # 更新全局贡献者统计: Counter.update在C层合并计数,
+                    # 比在构造contributor_list的循环里逐个累加更快
+                    commits_by_author.update(project_stats['commits_by_author'])
+                    mrs_by_author.update(project_stats['mrs_by_author'])
                 
-                stats['total_commits'] += project_stats['commit_count']
-                stats['total_merge_requests'] += project_stats['merge_request_count']
-                stats['projects'].append(formatted_stats)
-                stats['processed_projects'] += 1
+                    if project_stats.get('errors'):
+                        logger.warning("Partial data for project %s: %s", project_name, project_stats['errors'])
+                        stats['partial_data_projects'].append({
+                            'id': project_id,
+                            'name': project_name,
+                            'errors': project_stats['errors']
+                        })
                 
-                logger.info(f"Successfully processed project {project_name} - "
-                           f"Commits: {project_stats['commit_count']}, "
-                           f"MRs: {project_stats['merge_request_count']}")
+                    total_commits += project_stats['commit_count']
+                    total_merge_requests += project_stats['merge_request_count']
+                    processed_projects += 1
                 
-            except Exception as e:
-                logger.error(f"Error collecting stats for project {project_name}: {str(e)}")
-                stats['skipped_projects'].append({
-                    'id': project_id,
-                    'name': project_name,
-                    'reason': str(e)
-                })
-                continue
+                    logger.info("Successfully processed project %s - Commits: %s, MRs: %s",
+                                project_name,
+                                project_stats['commit_count'],
+                                project_stats['merge_request_count'])
+                    yield 'project', formatted_stats
+                
+                except (requests.exceptions.RequestException, GitLabAPIError) as e:
+                    logger.error("Error collecting stats for project %s: %s", project_name, e)
+                    stats['skipped_projects'].append({
+                        'id': project_id,
+                        'name': project_name,
+                        'reason': str(e)
+                    })
+                    continue
+        
+        stats['total_commits'] = total_commits
+        stats['total_merge_requests'] = total_merge_requests
+        stats['processed_projects'] = processed_projects
         
         # 添加统计摘要
         stats['summary'] = {
@@ -99,23 +179,65 @@ class GitLabStatsService:
             'partial_data_projects': len(stats['partial_data_projects'])
         }
         
-        logger.info(f"Statistics collection completed: {stats['summary']}")
+        logger.info("Statistics collection completed: %s", stats['summary'])
+        
+        stats['contributors'] = merge_contributors(commits_by_author, mrs_by_author)
+        yield 'summary', stats
+    
+    def _collect_project_stats_cached(self, project, start_date, end_date, need_contributors=True):
+        """项目自上次统计后没有新活动时, 直接复用缓存的统计结果"""
+        key = self._project_stats_key(project, start_date, end_date, need_contributors)
+        if key is None:
+            return self._collect_project_stats(project, start_date, end_date, need_contributors)
+        
+        cache = self.client.project_stats_cache
+        with self.client.project_stats_lock:
+            project_stats = cache.get(key)
+            if project_stats is not None:
+                cache.move_to_end(key)
+                return project_stats
+            cached_activity = self.client.project_stats_activity.get(project['id'])
+        
+        # 项目自上次缓存后有新活动时, 丢弃该项目缓存的响应, 避免用旧数据生成新的统计结果;
+        # 只是首次统计新区间时保留, 其他区间仍可复用
+        if cached_activity is not None and cached_activity != project['last_activity_at']:
+            self.client.invalidate(project['id'])
+        project_stats = self._collect_project_stats(project, start_date, end_date, need_contributors)
+        # 有错误的部分数据不缓存
+        if not project_stats['errors']:
+            with self.client.project_stats_lock:
+                cache[key] = project_stats
+                self.client.project_stats_activity[project['id']] = project['last_activity_at']
+                while len(cache) > PROJECT_STATS_CACHE_MAXSIZE:
+                    cache.popitem(last=False)
+        return project_stats
+    
+    def _project_stats_key(self, project, start_date, end_date, need_contributors):
+        """生成单项目统计的缓存键; 统计区间尚未结束时返回None, 不缓存
         
-        # 将defaultdict转换为普通dict
-        stats['contributors'] = dict(stats['contributors'])
-        return stats 
+        last_activity_at按小时节流更新, 包含当前时间的区间可能漏掉最新的提交
+        """
+        last_activity_at = project.get('last_activity_at')
+        end = parse_datetime(end_date)
+        if not last_activity_at or end is None or end >= datetime.now(timezone.utc):
+            return None
+        return (
+            project['id'],
+            last_activity_at,
+            start_date,
+            end_date,
+            need_contributors
+        )
     
-    def _collect_project_stats(self, project, start_date, end_date):
+    def _collect_project_stats(self, project, start_date, end_date, need_contributors=True):
         """收集单个项目的统计数据"""
         project_stats = {
             'id': project['id'],
             'name': project['name'],
             'commit_count': 0,
             'merge_request_count': 0,
-            'contributors': defaultdict(lambda: {
-                'commits': 0,
-                'merge_requests': 0
-            }),
+            'commits_by_author': Counter(),
+            'mrs_by_author': Counter(),
             'errors': [],  # 用于记录数据收集过程中的错误
             'status': {    # 新增: 记录数据获取状态
                 'commits_available': False,
@@ -123,22 +245,28 @@ class GitLabStatsService:
             }
         }
         
+        # 统计区间内不可能有commits和merge requests时, 跳过请求
+        if self._is_inactive_in_window(project, start_date, end_date):
+            logger.debug("Project %s has no activity between %s and %s, skipping fetch", project['id'], start_date, end_date)
+            project_stats['status']['commits_available'] = True
+            project_stats['status']['merge_requests_available'] = True
+            return project_stats
+        
+        # commits和merge requests互不依赖, 并发获取
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            commits_future = executor.submit(
+                self._count_commits, project['id'], start_date, end_date, need_contributors
+            )
+            merge_requests_future = executor.submit(
+                self._count_merge_requests, project['id'], start_date, end_date, need_contributors
+            )
+        
         # 尝试获取commits
         try:
-            commits = self.client.get_project_commits(
-                project['id'],
-                since=start_date,
-                until=end_date
-            )
-            project_stats['commit_count'] = len(commits)
+            project_stats['commit_count'], project_stats['commits_by_author'] = commits_future.result()
             project_stats['status']['commits_available'] = True
-            
-            # 统计贡献者信息
-            for commit in commits:
-                author = commit['author_name']
-                project_stats['contributors'][author]['commits'] += 1
-        except Exception as e:
-            logger.warning(f"Unable to get commits for project {project['id']}: {str(e)}")
+        except (requests.exceptions.RequestException, GitLabAPIError) as e:
+            logger.warning("Unable to get commits for project %s: %s", project['id'], e)
             project_stats['errors'].append({
                 'type': 'commits',
                 'error': str(e)
@@ -146,25 +274,55 @@ class GitLabStatsService:
         
         # 尝试获取merge requests
         try:
-            merge_requests = self.client.get_project_merge_requests(
-                project['id'],
-                since=start_date,
-                until=end_date
-            )
-            project_stats['merge_request_count'] = len(merge_requests)
+            project_stats['merge_request_count'], project_stats['mrs_by_author'] = merge_requests_future.result()
             project_stats['status']['merge_requests_available'] = True
-            
-            # 统计合并请求的贡献者信息
-            for mr in merge_requests:
-                if 'author' in mr and 'name' in mr['author']:
-                    author = mr['author']['name']
-                    project_stats['contributors'][author]['merge_requests'] += 1
-        except Exception as e:
-            logger.warning(f"Unable to get merge requests for project {project['id']}: {str(e)}")
+        except (requests.exceptions.RequestException, GitLabAPIError) as e:
+            logger.warning("Unable to get merge requests for project %s: %s", project['id'], e)
             project_stats['errors'].append({
                 'type': 'merge_requests',
                 'error': str(e)
             })
         
         # 修改返回逻辑: 即使没有数据也返回结果
-        return project_stats 
\ No newline at end of file
+        return project_stats
+    
+    def _count_commits(self, project_id, start_date, end_date, need_contributors=True):
+        """统计项目commits, 返回(总数, 按作者计数的Counter)"""
+        if not need_contributors:
+            # 只需要总数时读取X-Total, 不拉取commit列表
+            count = self.client.get_project_commit_count(project_id, since=start_date, until=end_date)
+            return count, Counter()
+        
+        # 边分页边统计贡献者信息, 不保留完整的commit列表
+        commits = self.client.iter_project_commits(project_id, since=start_date, until=end_date)
+        # 作者名在各项目间大量重复, intern后各Counter共享同一个字符串对象
+        commits_by_author = Counter(sys.intern(commit['author_name']) for commit in commits)
+        return sum(commits_by_author.values()), commits_by_author
+    
+    def _count_merge_requests(self, project_id, start_date, end_date, need_contributors=True):
+        """统计项目merge requests, 返回(总数, 按作者计数的Counter)"""
+        if not need_contributors:
+            count = self.client.get_project_merge_request_count(project_id, since=start_date, until=end_date)
+            return count, Counter()
+        
+        # 边分页边统计合并请求的贡献者信息, 不保留完整的列表
+        merge_requests = self.client.iter_project_merge_requests(project_id, since=start_date, until=end_date)
+        merge_request_count = 0
+        mrs_by_author = Counter()
+        for mr in merge_requests:
+            merge_request_count += 1
+            author = mr.get('author') or {}
+            if 'name' in author:
+                mrs_by_author[sys.intern(author['name'])] += 1
+        return merge_request_count, mrs_by_author
+    
+    @staticmethod
+    def _is_inactive_in_window(project, start_date, end_date):
+        """统计区间为空, 或项目在区间开始前已无活动时返回True"""
+        start = parse_datetime(start_date)
+        end = parse_datetime(end_date)
+        if start is not None and end is not None and start >= end:
+            return True
+        last_activity = parse_datetime(project.get('last_activity_at'))
+        return last_activity is not None and start is not None and last_activity < start
+
@@ -0,0 +1,13 @@
+from datetime import datetime, timezone
+
+def parse_datetime(value):
+    """解析ISO8601时间字符串, 无时区的按UTC处理; 无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed